@@ -1,5 +1,7 @@
+import concurrent.futures
 import csv
 import itertools
+import math
 import sys
 
 PROBS = {
@@ -16,34 +18,106 @@ PROBS = {
     "mutation": 0.01
 }
 
+# Probability that a parent with a given number of genes passes one on
+PASSING_PROB = {
+    0: PROBS["mutation"],
+    1: 0.5,
+    2: 1 - PROBS["mutation"]
+}
+
+# The tables below hold the same values as PROBS, as lists indexed by
+# number of genes (and by 0/1 for the trait) so lookups avoid hashing
+GENE_PRIOR = [PROBS["gene"][genes] for genes in range(3)]
+TRAIT_TABLE = [
+    [PROBS["trait"][genes][False], PROBS["trait"][genes][True]]
+    for genes in range(3)
+]
+
+def inheritance_table():
+    table = [[None] * 3 for _ in range(3)]
+    for mother_genes, mother_pass in PASSING_PROB.items():
+        for father_genes, father_pass in PASSING_PROB.items():
+            table[mother_genes][father_genes] = [
+                (1 - mother_pass) * (1 - father_pass),
+                (mother_pass * (1 - father_pass) +
+                 (1 - mother_pass) * father_pass),
+                mother_pass * father_pass
+            ]
+    return table
+
+# Probability of a child's number of genes, indexed by its mother's genes,
+# its father's genes and then its own
+INHERITANCE = inheritance_table()
+
+# Joint probabilities are accumulated in log space to avoid underflow
+LOG_GENE_PRIOR = [math.log(p) for p in GENE_PRIOR]
+LOG_TRAIT_TABLE = [[math.log(p) for p in row] for row in TRAIT_TABLE]
+LOG_INHERITANCE = [
+    [[math.log(p) for p in child] for child in father]
+    for father in INHERITANCE
+]
+
+# Relative probability below which an assignment is skipped
+LOG_PRUNE_THRESHOLD = math.log(1e-18)
+
+# Pedigrees at least this large are enumerated in parallel, split on the
+# gene counts of their first PARALLEL_SPLIT people
+PARALLEL_MIN_PEOPLE = 10
+PARALLEL_SPLIT = 3
+
 def main():
     if len(sys.argv) != 2:
         sys.exit("Usage: python heredity.py data.csv")
     people = load_data(sys.argv[1])
 
+    pedigree = load_pedigree(people)
+    evidence = [people[person]["trait"] for person in people]
+
+    # People with known trait evidence keep their bit fixed in every mask;
+    # each person without evidence doubles the masks, with and without them
+    trait_masks = [
+        sum(1 << i for i, trait in enumerate(evidence) if trait)
+    ]
+    for i, trait in enumerate(evidence):
+        if trait is None:
+            trait_masks += [mask | 1 << i for mask in trait_masks]
+
+    # Split larger pedigrees by the genes of their first few people and
+    # enumerate each part in its own process
+    if len(pedigree) >= PARALLEL_MIN_PEOPLE:
+        prefixes = list(itertools.product((0, 1, 2), repeat=PARALLEL_SPLIT))
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            results = list(executor.map(
+                enumerate_assignments,
+                itertools.repeat(pedigree),
+                itertools.repeat(evidence),
+                itertools.repeat(trait_masks),
+                prefixes
+            ))
+    else:
+        results = [enumerate_assignments(pedigree, evidence, trait_masks, ())]
+
+    # Bring every part's totals to the same offset before adding them up
+    offset = max(result[0] for result in results)
+    gene_totals = [[0, 0, 0] for _ in pedigree]
+    trait_totals = [[0, 0] for _ in pedigree]
+    for part_offset, part_gene_totals, part_trait_totals in results:
+        factor = math.exp(part_offset - offset)
+        for totals, part_totals in (
+            (gene_totals, part_gene_totals),
+            (trait_totals, part_trait_totals)
+        ):
+            for row, part_row in zip(totals, part_totals):
+                for value in range(len(row)):
+                    row[value] += part_row[value] * factor
+
     probabilities = {
         person: {
-            "gene": {2: 0, 1: 0, 0: 0},
-            "trait": {True: 0, False: 0}
+            "gene": {genes: gene_totals[i][genes] for genes in (2, 1, 0)},
+            "trait": {True: trait_totals[i][1], False: trait_totals[i][0]}
         }
-        for person in people
+        for i, person in enumerate(people)
     }
-
-    names = set(people)
-    for have_trait in powerset(names):
-        fails_evidence = any(
-            (people[person]["trait"] is not None and
-             people[person]["trait"] != (person in have_trait))
-            for person in names
-        )
-        if fails_evidence:
-            continue
-
-        for one_gene in powerset(names):
-            for two_genes in powerset(names - one_gene):
-                p = joint_probability(people, one_gene, two_genes, have_trait)
-                update(probabilities, one_gene, two_genes, have_trait, p)
-
     normalize(probabilities)
 
     for person in people:
@@ -54,6 +128,38 @@ def main():
                 p = probabilities[person][field][value]
                 print(f"    {value}: {p:.4f}")
 
+# Sum the joint probability of every assignment whose first people have
+# the gene counts in `prefix`, returning the totals together with the log
+# offset they are relative to
+def enumerate_assignments(pedigree, evidence, trait_masks, prefix):
+    gene_log_probability, trait_log_probability = compile_pedigree(
+        pedigree, evidence
+    )
+
+    # Accumulate each probability relative to the largest one seen so far,
+    # which keeps the sums representable; the offset cancels out in normalize
+    offset = -math.inf
+    gene_totals = [[0, 0, 0] for _ in pedigree]
+    trait_totals = [[0, 0] for _ in pedigree]
+    for rest in itertools.product((0, 1, 2), repeat=len(pedigree) - len(prefix)):
+        genes = prefix + rest
+
+        # Skip assignments that are negligible next to the largest so far
+        cutoff = offset + LOG_PRUNE_THRESHOLD
+        gene_log_p = gene_log_probability(genes, cutoff)
+        if gene_log_p < cutoff:
+            continue
+        for trait_mask in trait_masks:
+            log_p = gene_log_p + trait_log_probability(genes, trait_mask)
+            if log_p > offset:
+                rescale(gene_totals, math.exp(offset - log_p))
+                rescale(trait_totals, math.exp(offset - log_p))
+                offset = log_p
+            p = math.exp(log_p - offset)
+            update_totals(gene_totals, trait_totals, genes, trait_mask, p)
+
+    return offset, gene_totals, trait_totals
+
 def load_data(filename):
     data = dict()
     with open(filename) as f:
@@ -71,68 +177,128 @@ def load_data(filename):
 
 def powerset(s):
     s = list(s)
+    for subset in itertools.chain.from_iterable(
+        itertools.combinations(s, r) for r in range(len(s) + 1)
+    ):
+        yield set(subset)
+
+def load_pedigree(people):
+    index = {person: i for i, person in enumerate(people)}
     return [
-        set(s) for s in itertools.chain.from_iterable(
-            itertools.combinations(s, r) for r in range(len(s) + 1)
-        )
+        None if people[person]["mother"] is None else
+        (index[people[person]["mother"]], index[people[person]["father"]])
+        for person in people
     ]
 
+def to_masks(people, one_gene, two_genes, have_trait):
+    genes = tuple(
+        2 if person in two_genes else
+        1 if person in one_gene else
+        0
+        for person in people
+    )
+    trait_mask = sum(
+        1 << i for i, person in enumerate(people) if person in have_trait
+    )
+    return genes, trait_mask
+
 def joint_probability(people, one_gene, two_genes, have_trait):
-    probability = 1
-    for person in people:
-        genes = (
-            2 if person in two_genes else
-            1 if person in one_gene else
-            0
-        )
-        has_trait = person in have_trait
-
-        if people[person]["mother"] is None:
-            probability *= PROBS["gene"][genes]
+    genes, trait_mask = to_masks(people, one_gene, two_genes, have_trait)
+    return math.exp(
+        assignment_log_probability(load_pedigree(people), genes, trait_mask)
+    )
+
+def assignment_log_probability(pedigree, genes, trait_mask):
+    log_probability = 0
+    for i, parents in enumerate(pedigree):
+        person_genes = genes[i]
+
+        if parents is None:
+            log_probability += LOG_GENE_PRIOR[person_genes]
         else:
-            mother = people[person]["mother"]
-            father = people[person]["father"]
-            mother_genes = (
-                2 if mother in two_genes else
-                1 if mother in one_gene else
-                0
-            )
-            father_genes = (
-                2 if father in two_genes else
-                1 if father in one_gene else
-                0
+            mother, father = parents
+            log_probability += (
+                LOG_INHERITANCE[genes[mother]][genes[father]][person_genes]
             )
-            passing_prob = {
-                0: PROBS["mutation"],
-                1: 0.5,
-                2: 1 - PROBS["mutation"]
-            }
 
-            if genes == 2:
-                probability *= passing_prob[mother_genes] * passing_prob[father_genes]
-            elif genes == 1:
-                probability *= (
-                    passing_prob[mother_genes] * (1 - passing_prob[father_genes]) +
-                    (1 - passing_prob[mother_genes]) * passing_prob[father_genes]
-                )
-            else:
-                probability *= (1 - passing_prob[mother_genes]) * (1 - passing_prob[father_genes])
+        log_probability += LOG_TRAIT_TABLE[person_genes][(trait_mask >> i) & 1]
 
-        probability *= PROBS["trait"][genes][has_trait]
+    return log_probability
 
-    return probability
+# Generate a version of assignment_log_probability specialized to
+# `pedigree`, with the loop over people unrolled into straight-line code.
+# It is split into a factor that depends only on the gene assignment (which
+# includes the trait terms fixed by `evidence`) and one for the trait bits
+# of people without evidence
+def compile_pedigree(pedigree, evidence):
+    # Children come first, since unlikely inheritance is what usually lets
+    # the gene factor fall below the cutoff early
+    order = (
+        [i for i, parents in enumerate(pedigree) if parents is not None] +
+        [i for i, parents in enumerate(pedigree) if parents is None]
+    )
+
+    gene_terms = []
+    for i in order:
+        if pedigree[i] is None:
+            term = f"LOG_GENE_PRIOR[genes[{i}]]"
+        else:
+            mother, father = pedigree[i]
+            term = f"LOG_INHERITANCE[genes[{mother}]][genes[{father}]][genes[{i}]]"
+        if evidence[i] is not None:
+            term += f" + LOG_TRAIT_TABLE[genes[{i}]][{int(evidence[i])}]"
+        gene_terms.append(term)
+
+    trait_terms = [
+        f"LOG_TRAIT_TABLE[genes[{i}]][(trait_mask >> {i}) & 1]"
+        for i in range(len(pedigree))
+        if evidence[i] is None
+    ]
+
+    source = (
+        compile_pruned_sum("gene_log_probability", "genes, cutoff", gene_terms) +
+        compile_sum("trait_log_probability", "genes, trait_mask", trait_terms)
+    )
+    namespace = {
+        "LOG_GENE_PRIOR": LOG_GENE_PRIOR,
+        "LOG_INHERITANCE": LOG_INHERITANCE,
+        "LOG_TRAIT_TABLE": LOG_TRAIT_TABLE
+    }
+    exec(source, namespace)
+    return namespace["gene_log_probability"], namespace["trait_log_probability"]
+
+def compile_sum(name, arguments, terms):
+    return (
+        f"def {name}({arguments}):\n"
+        "    return (\n        " + "\n        + ".join(terms or ["0"]) + "\n    )\n"
+    )
+
+# Like compile_sum, but stops adding terms as soon as the sum drops below
+# `cutoff`; every term is a log-probability, so the sum can only decrease
+def compile_pruned_sum(name, arguments, terms):
+    lines = [f"def {name}({arguments}):", "    log_p = 0"]
+    for term in terms:
+        lines.append(f"    log_p += {term}")
+        lines.append("    if log_p < cutoff:")
+        lines.append("        return log_p")
+    lines.append("    return log_p")
+    return "\n".join(lines) + "\n"
 
 def update(probabilities, one_gene, two_genes, have_trait, p):
-    for person in probabilities:
-        genes = (
-            2 if person in two_genes else
-            1 if person in one_gene else
-            0
-        )
-        has_trait = person in have_trait
-
-        probabilities[person]["gene"][genes] += p
-        probabilities[person]["trait"][has_trait] += p
+    genes, trait_mask = to_masks(probabilities, one_gene, two_genes, have_trait)
+    for i, person in enumerate(probabilities):
+        probabilities[person]["gene"][genes[i]] += p
+        probabilities[person]["trait"][(trait_mask >> i) & 1 == 1] += p
+
+def update_totals(gene_totals, trait_totals, genes, trait_mask, p):
+    for i, person_genes in enumerate(genes):
+        gene_totals[i][person_genes] += p
+        trait_totals[i][(trait_mask >> i) & 1] += p
+
+def rescale(totals, factor):
+    for row in totals:
+        for value in range(len(row)):
+            row[value] *= factor
 
 def normalize(probabilities):
     for person in probabilities:
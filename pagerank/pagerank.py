@@ -6,6 +6,8 @@ import sys
 DAMPING = 0.85
 SAMPLES = 10000
 
+LINK_PATTERN = re.compile(rb"<a\s+(?:[^>]*?)href=\"([^\"]*)\"")
+
 
 def main():
     if len(sys.argv) != 2:
@@ -33,10 +35,10 @@ def crawl(directory):
     for filename in os.listdir(directory):
         if not filename.endswith(".html"):
             continue
-        with open(os.path.join(directory, filename)) as f:
+        with open(os.path.join(directory, filename), "rb") as f:
             contents = f.read()
-            links = re.findall(r"<a\s+(?:[^>]*?)href=\"([^\"]*)\"", contents)
-            pages[filename] = set(links) - {filename}
+            links = {link.decode() for link in LINK_PATTERN.findall(contents)}
+            pages[filename] = links - {filename}
 
     # Only include links to other pages in the corpus
     for filename in pages:
@@ -75,6 +77,37 @@ def transition_model(corpus, page, damping_factor):
     raise NotImplementedError
 
 
+def alias_table(probabilities):
+    """
+    Build a Walker alias table for sampling from `probabilities`.
+
+    Return a pair of lists `(accept, alias)`: pick a column `i` uniformly
+    at random, then keep `i` with probability `accept[i]` and otherwise
+    take `alias[i]`.
+    """
+    n = len(probabilities)
+    accept = [p * n for p in probabilities]
+    alias = list(range(n))
+    small = [i for i in range(n) if accept[i] < 1]
+    large = [i for i in range(n) if accept[i] >= 1]
+
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        alias[less] = more
+        accept[more] -= 1 - accept[less]
+        if accept[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+
+    # Anything left over is within rounding error of a full column
+    for i in small + large:
+        accept[i] = 1
+
+    return accept, alias
+
+
 def sample_pagerank(corpus, damping_factor, n):
     """
     Return PageRank values for each page by sampling `n` pages
@@ -84,19 +117,29 @@ def sample_pagerank(corpus, damping_factor, n):
     their estimated PageRank value (a value between 0 and 1). All
     PageRank values should sum to 1.
     """
-    page = random.choice(list(corpus.keys()))
-    page_rank = {page: 0 for page in corpus}
-    
-    for _ in range(n):
-        page_rank[page] += 1
+    pages = list(corpus)
+    num_pages = len(pages)
+
+    # The transition model only depends on the current page, so build the
+    # alias table for every page once instead of once per sample
+    alias_tables = []
+    for page in pages:
         prob_dist = transition_model(corpus, page, damping_factor)
-        page = random.choices(list(prob_dist.keys()), weights=prob_dist.values(), k=1)[0]
-    
-    total_samples = sum(page_rank.values())
-    for page in page_rank:
-        page_rank[page] /= total_samples
-    
-    return page_rank
+        alias_tables.append(alias_table([prob_dist[p] for p in pages]))
+
+    current = random.randrange(num_pages)
+    visits = [0] * num_pages
+
+    for _ in range(n):
+        visits[current] += 1
+        # The integer part of the draw picks a column of the current page's
+        # table, and the fractional part decides between it and its alias
+        accept, alias = alias_tables[current]
+        x = random.random() * num_pages
+        column = int(x)
+        current = column if x - column < accept[column] else alias[column]
+
+    return {page: visits[i] / n for i, page in enumerate(pages)}
     raise NotImplementedError
 
 
@@ -109,32 +152,57 @@ def iterate_pagerank(corpus, damping_factor):
     their estimated PageRank value (a value between 0 and 1). All
     PageRank values should sum to 1.
     """
-    num_pages = len(corpus)
-    page_rank = {page: 1 / num_pages for page in corpus}
-    new_rank = page_rank.copy()
-    
+    pages = list(corpus)
+    num_pages = len(pages)
+    index = {page: i for i, page in enumerate(pages)}
+
+    # Links are stored in compressed sparse row form: the pages linking to
+    # page i are indices[indptr[i]:indptr[i + 1]], and weights holds the
+    # probability of following each of those links. Pages with no links
+    # link to every page, which is handled separately as one shared term
+    inbound = [[] for _ in pages]
+    dangling = []
+    for j, page in enumerate(pages):
+        if corpus[page]:
+            weight = 1 / len(corpus[page])
+            for linked_page in corpus[page]:
+                inbound[index[linked_page]].append((j, weight))
+        else:
+            dangling.append(j)
+
+    indptr = [0]
+    indices = []
+    weights = []
+    for links in inbound:
+        for j, weight in links:
+            indices.append(j)
+            weights.append(weight)
+        indptr.append(len(indices))
+
+    page_rank = [1 / num_pages] * num_pages
+    new_rank = [0] * num_pages
+
     convergence_threshold = 0.001
-    converged = False
-    
-    while not converged:
-        converged = True
-        for page in corpus:
-            rank_sum = sum(page_rank[linking_page] / len(corpus[linking_page]) 
-                           for linking_page in corpus if page in corpus[linking_page])
-            new_rank[page] = (1 - damping_factor) / num_pages + damping_factor * rank_sum
-        
-        for page in page_rank:
-            if abs(new_rank[page] - page_rank[page]) > convergence_threshold:
-                converged = False
-        
-        page_rank = new_rank.copy()
-    
+    random_jump = (1 - damping_factor) / num_pages
+    max_change = convergence_threshold + 1
+
+    while max_change > convergence_threshold:
+        max_change = 0
+        dangling_sum = sum(page_rank[j] for j in dangling) / num_pages
+        for i in range(num_pages):
+            rank_sum = dangling_sum
+            for k in range(indptr[i], indptr[i + 1]):
+                rank_sum += page_rank[indices[k]] * weights[k]
+            new_rank[i] = random_jump + damping_factor * rank_sum
+            max_change = max(max_change, abs(new_rank[i] - page_rank[i]))
+
+        # Every entry of new_rank is rewritten each iteration, so the two
+        # lists can simply trade places
+        page_rank, new_rank = new_rank, page_rank
+
     # Ensure the ranks sum to 1
-    norm_factor = sum(page_rank.values())
-    for page in page_rank:
-        page_rank[page] /= norm_factor
-    
-    return page_rank
+    norm_factor = sum(page_rank)
+    return {page: page_rank[i] / norm_factor for i, page in enumerate(pages)}
     raise NotImplementedError
 
 